@@ -0,0 +1,207 @@
+"""Day-partitioned chat history archive for Zeny AI.
+
+Messages are archived one whole UTC day at a time into gzip NDJSON files:
+    <archive_dir>/date=YYYY-MM-DD/part-<batch>.ndjson.gz
+so each day normally has a single part file.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import uuid
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def archive_partition(archive_dir: Path, day: date) -> Path:
+    return archive_dir / f"date={day.isoformat()}"
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class ArchivePartWriter:
+    """Writes one part file for a day; nothing is visible until commit()"""
+
+    def __init__(self, archive_dir: Path, day: date):
+        self.partition = archive_partition(archive_dir, day)
+        self.partition.mkdir(parents=True, exist_ok=True)
+        batch_id = uuid.uuid4().hex
+        self.path = self.partition / f"part-{batch_id}.ndjson.gz"
+        self.tmp_path = self.partition / f".part-{batch_id}.ndjson.gz.tmp"
+        self._raw = open(self.tmp_path, 'wb')
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode='wb')
+
+    def write(self, records: List[dict]):
+        for record in records:
+            self._gzip.write((json.dumps(record, default=_json_default) + "\n").encode('utf-8'))
+
+    def commit(self):
+        # Close the gzip stream first so its trailer is on disk before fsync
+        self._gzip.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        os.replace(self.tmp_path, self.path)
+        _fsync_dir(self.partition)
+        _fsync_dir(self.partition.parent)
+
+    def abort(self):
+        self._gzip.close()
+        self._raw.close()
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+def read_archive_day(archive_dir: Path, day: date, avatar_id: Optional[str] = None) -> List[dict]:
+    """Read one day's archived records, newest first"""
+    partition = archive_partition(archive_dir, day)
+    if not partition.is_dir():
+        return []
+
+    # A day interrupted between writing and deleting is archived again on the
+    # next pass, so duplicates are dropped by message id.
+    records: Dict[str, dict] = {}
+    for path in sorted(partition.glob("part-*.ndjson.gz")):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                file_records = [json.loads(line) for line in f if line.strip()]
+            for record in file_records:
+                record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+        except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Skipping unreadable chat archive file {path}: {e}")
+            continue
+        for record in file_records:
+            if avatar_id is None or record.get('avatar_id') == avatar_id:
+                records[record['id']] = record
+    return sorted(records.values(), key=lambda r: r['timestamp'], reverse=True)
+
+async def query_chat_archive(archive_dir: Path, start_date: date, end_date: date,
+                             avatar_id: Optional[str], limit: int) -> List[dict]:
+    """Read archived records newest first, one day partition at a time"""
+    loop = asyncio.get_running_loop()
+    results: List[dict] = []
+    day = end_date
+    while day >= start_date and len(results) < limit:
+        results.extend(await loop.run_in_executor(None, read_archive_day, archive_dir, day, avatar_id))
+        day -= timedelta(days=1)
+    return results[:limit]
+
+async def _archive_day(collection, quarantine, archive_dir: Path, day: date,
+                       validate: Callable[[dict], dict], batch_size: int) -> Tuple[int, int]:
+    """Archive one day; returns (archived, quarantined) counts"""
+    loop = asyncio.get_running_loop()
+    start = datetime.combine(day, time.min)
+    cursor = collection.find({"timestamp": {"$gte": start, "$lt": start + timedelta(days=1)}}).sort("timestamp", 1)
+
+    writer = await loop.run_in_executor(None, ArchivePartWriter, archive_dir, day)
+    archived_ids = []
+    quarantined = 0
+    batch: List[dict] = []
+    try:
+        async for doc in cursor:
+            try:
+                record = validate(doc)
+            except Exception as e:
+                # Quarantine instead of failing: the oldest day would otherwise
+                # block every future pass.
+                logger.error(f"Quarantining invalid chat message {doc.get('_id')}: {e}")
+                await quarantine.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+                await collection.delete_many({"_id": {"$in": [doc["_id"]]}})
+                quarantined += 1
+                continue
+
+            batch.append(record)
+            archived_ids.append(doc["_id"])
+            if len(batch) >= batch_size:
+                await loop.run_in_executor(None, writer.write, batch)
+                batch = []
+
+        if not archived_ids:
+            await loop.run_in_executor(None, writer.abort)
+            return 0, quarantined
+        if batch:
+            await loop.run_in_executor(None, writer.write, batch)
+        await loop.run_in_executor(None, writer.commit)
+    except Exception:
+        # On cancellation the writer may still be busy in its thread; the
+        # dot-prefixed temp file is left behind and ignored by readers.
+        await loop.run_in_executor(None, writer.abort)
+        raise
+
+    for i in range(0, len(archived_ids), batch_size):
+        await collection.delete_many({"_id": {"$in": archived_ids[i:i + batch_size]}})
+    return len(archived_ids), quarantined
+
+async def archive_chat_history(collection, quarantine, archive_dir: Path, cutoff_date: date,
+                               validate: Callable[[dict], dict], batch_size: int) -> int:
+    """Move messages from days before cutoff_date into the archive.
+
+    Days are archived whole, oldest first, into one part file each. Documents
+    that fail validate() are moved to the quarantine collection.
+    """
+    cutoff = datetime.combine(cutoff_date, time.min)
+    archived = 0
+    while True:
+        oldest = await collection.find({"timestamp": {"$lt": cutoff}}).sort("timestamp", 1).to_list(1)
+        if not oldest:
+            break
+        day = oldest[0]["timestamp"].date()
+        day_archived, day_quarantined = await _archive_day(collection, quarantine, archive_dir, day, validate, batch_size)
+        if not day_archived and not day_quarantined:
+            logger.error(f"No chat messages could be archived for {day}; stopping this pass")
+            break
+        archived += day_archived
+    return archived
+
+def resolve_ttl_seconds(ttl_days: int, retention_days: int) -> Optional[int]:
+    """TTL for the hot collection, or None when disabled or unsafe"""
+    if ttl_days <= 0:
+        return None
+    if ttl_days <= retention_days:
+        logger.error(
+            f"CHAT_HOT_TTL_DAYS ({ttl_days}) must exceed CHAT_HOT_RETENTION_DAYS "
+            f"({retention_days}); TTL disabled so unarchived messages are not expired"
+        )
+        return None
+    return ttl_days * 86400
+
+async def reconcile_timestamp_index(collection, index_name: str, ttl_seconds: Optional[int]) -> str:
+    """Ensure a single named timestamp index with the requested TTL.
+
+    The TTL is changed in place with collMod; the index is rebuilt when the
+    TTL has to be added or removed. Other timestamp indexes are dropped.
+    Returns the action taken.
+    """
+    indexes = await collection.index_information()
+    for name, spec in indexes.items():
+        if name != index_name and [field for field, _ in spec['key']] == ["timestamp"]:
+            await collection.drop_index(name)
+
+    existing = indexes.get(index_name)
+    if existing is not None:
+        current = existing.get('expireAfterSeconds')
+        if current == ttl_seconds:
+            return "unchanged"
+        if current is not None and ttl_seconds is not None:
+            await collection.database.command({
+                "collMod": collection.name,
+                "index": {"name": index_name, "expireAfterSeconds": ttl_seconds},
+            })
+            return "updated"
+        await collection.drop_index(index_name)
+
+    options = {"expireAfterSeconds": ttl_seconds} if ttl_seconds is not None else {}
+    await collection.create_index([("timestamp", -1)], name=index_name, **options)
+    return "created" if existing is None else "rebuilt"
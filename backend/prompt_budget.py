@@ -0,0 +1,189 @@
+"""Token budgeting for Zeny AI avatar prompts"""
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PromptTooLarge(Exception):
+    """Raised when a user message cannot be made to fit the model's input budget"""
+
+class PersonaTooLarge(Exception):
+    """Raised when an avatar's persona cannot fit its budget; an avatar configuration error"""
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate used when the model cannot count tokens"""
+    return max(1, len(text) // 4)
+
+def build_persona_prompt(name: str, description: str, personality: str, instructions: str) -> str:
+    return f"""You are {name}, an AI avatar with the following characteristics:
+
+Description: {description}
+Personality: {personality}
+Instructions: {instructions}
+
+You should respond in character as {name} with the specified personality. Be natural, engaging, and follow your instructions. Keep responses conversational and appropriately sized for a chat interface (1-3 paragraphs maximum).
+
+"""
+
+def build_user_prompt(avatar: dict, user_message: str) -> str:
+    return f"""User message: {user_message}
+
+Respond as {avatar['name']}:"""
+
+def output_token_bounds(model_configs: Dict[str, dict]) -> Tuple[int, int]:
+    """Range of per-avatar max_output_tokens values that every model honours"""
+    return (
+        max(config['min_output_tokens'] for config in model_configs.values()),
+        max(config['max_output_tokens'] for config in model_configs.values()),
+    )
+
+def parse_generation_response(response, estimated_prompt_tokens: int) -> Tuple[Optional[str], int, Optional[int]]:
+    """Extract (text, prompt_tokens, response_tokens) from a Gemini response.
+
+    text is None when the output cap was used up, typically by thinking,
+    before any text was produced.
+    """
+    prompt_tokens = estimated_prompt_tokens
+    response_tokens = None
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        prompt_tokens = usage.prompt_token_count or prompt_tokens
+        response_tokens = (usage.total_token_count or 0) - (usage.prompt_token_count or 0) or None
+
+    candidate = response.candidates[0] if response.candidates else None
+    if candidate is not None and not candidate.content.parts \
+            and getattr(candidate.finish_reason, "name", None) == "MAX_TOKENS":
+        return None, prompt_tokens, response_tokens
+    return response.text.strip(), prompt_tokens, response_tokens
+
+class PromptBudget:
+    """Token accounting for avatar prompts.
+
+    Persona prompts are counted once per model and avatar revision and kept in
+    an LRU cache, including personas that cannot fit. A persona may use at
+    most half of the model's input budget; description and personality are
+    each capped at a quarter of the persona budget and instructions get the
+    rest. User messages are only sent to count_tokens when their UTF-8 size
+    could exceed the remaining input budget, since a token never covers less
+    than one byte.
+    """
+
+    def __init__(self, model_configs: Dict[str, dict], default_model: str, max_persona_tokens: int,
+                 overflow_policy: str, cache_size: int):
+        self.model_configs = model_configs
+        self.default_model = default_model
+        self.max_persona_tokens = max_persona_tokens
+        self.overflow_policy = overflow_policy
+        self.cache_size = cache_size
+        self._persona_cache: "OrderedDict[tuple, Optional[Tuple[str, int]]]" = OrderedDict()
+
+    def model_config(self, model_name: str) -> dict:
+        return self.model_configs.get(model_name, self.model_configs[self.default_model])
+
+    async def count_tokens(self, model, text: str) -> int:
+        if model is None:
+            return estimate_tokens(text)
+        try:
+            result = await model.count_tokens_async(text)
+            return result.total_tokens
+        except Exception as e:
+            logger.warning(f"Token counting failed, using estimate: {e}")
+            return estimate_tokens(text)
+
+    async def _fit(self, model, text: str, render: Callable[[str], str], limit: int,
+                   allow_empty: bool = False) -> Optional[Tuple[str, int]]:
+        """Shorten text until render(text) fits within limit tokens.
+
+        Returns None if it cannot fit without emptying text, unless
+        allow_empty is set and the empty rendering fits.
+        """
+        tokens = await self.count_tokens(model, render(text))
+        if tokens <= limit:
+            return text, tokens
+
+        # Scale only the variable part; the template around text is fixed
+        overhead = await self.count_tokens(model, render(""))
+        if overhead > limit:
+            return None
+        for _ in range(4):
+            keep = int(len(text) * (limit - overhead) / max(tokens - overhead, 1) * 0.95)
+            if keep <= 0:
+                break
+            text = text[:keep]
+            tokens = await self.count_tokens(model, render(text))
+            if tokens <= limit:
+                return text, tokens
+
+        if allow_empty:
+            return "", overhead
+        return None
+
+    async def _build_persona(self, avatar: dict, limit: int, model) -> Optional[Tuple[str, int]]:
+        field_limit = max(limit // 4, 1)
+        description, _ = await self._fit(model, avatar['description'], lambda text: text, field_limit, allow_empty=True) or ("", 0)
+        personality, _ = await self._fit(model, avatar['personality'], lambda text: text, field_limit, allow_empty=True) or ("", 0)
+        fitted = await self._fit(
+            model,
+            avatar['instructions'],
+            lambda text: build_persona_prompt(avatar['name'], description, personality, text),
+            limit,
+            allow_empty=True,
+        )
+        if fitted is None:
+            return None
+
+        instructions, tokens = fitted
+        if (description, personality, instructions) != (avatar['description'], avatar['personality'], avatar['instructions']):
+            logger.warning(f"Persona for avatar {avatar.get('id')} truncated to fit {limit} tokens")
+        return build_persona_prompt(avatar['name'], description, personality, instructions), tokens
+
+    async def persona(self, avatar: dict, model_name: str, model) -> Tuple[str, int]:
+        """Return the persona prompt for an avatar and its token count.
+
+        Raises PersonaTooLarge if even the avatar's name does not fit.
+        """
+        key = (model_name, avatar.get('id'), avatar.get('updated_at'))
+        if key in self._persona_cache:
+            self._persona_cache.move_to_end(key)
+            entry = self._persona_cache[key]
+        else:
+            limit = min(self.max_persona_tokens, self.model_config(model_name)['max_input_tokens'] // 2)
+            entry = await self._build_persona(avatar, limit, model)
+            self._persona_cache[key] = entry
+            if len(self._persona_cache) > self.cache_size:
+                self._persona_cache.popitem(last=False)
+
+        if entry is None:
+            raise PersonaTooLarge()
+        return entry
+
+    async def user_prompt(self, avatar: dict, user_message: str, model, limit: int) -> Tuple[str, int]:
+        """Return the user part of the prompt, truncated or rejected if over limit"""
+        if limit <= 0:
+            raise PromptTooLarge()
+
+        def render(text: str) -> str:
+            return build_user_prompt(avatar, text)
+
+        prompt = render(user_message)
+        if len(prompt.encode('utf-8')) <= limit:
+            return prompt, estimate_tokens(prompt)
+
+        if self.overflow_policy == 'reject':
+            tokens = await self.count_tokens(model, prompt)
+            if tokens > limit:
+                raise PromptTooLarge()
+            return prompt, tokens
+
+        fitted = await self._fit(model, user_message, render, limit)
+        if fitted is None:
+            raise PromptTooLarge()
+        message, tokens = fitted
+        return render(message), tokens
+
+    def max_output_tokens(self, avatar: dict, model_name: str) -> int:
+        config = self.model_config(model_name)
+        requested = avatar.get('max_output_tokens') or config['max_output_tokens']
+        return max(config['min_output_tokens'], min(requested, config['max_output_tokens']))
@@ -0,0 +1,207 @@
+"""Admission control for the Zeny AI API"""
+import asyncio
+import ipaddress
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request cannot be admitted by the scheduler"""
+
+class _Waiter:
+    __slots__ = ("client_key", "avatar_id", "avatar_limit", "future")
+
+    def __init__(self, client_key: str, avatar_id: Optional[str], avatar_limit: int):
+        self.client_key = client_key
+        self.avatar_id = avatar_id
+        self.avatar_limit = avatar_limit
+        self.future = asyncio.get_running_loop().create_future()
+
+class FairScheduler:
+    """Admission control with per-client fair queuing and an admin priority lane.
+
+    Public requests are queued per client and dispatched round-robin across
+    clients, subject to per-client and per-avatar concurrency limits. Clients
+    are ordered by when they were last served, so a client that was just
+    admitted waits behind clients that have been queued since. Admin
+    requests are dispatched ahead of public ones and may also use a number of
+    reserved slots that public traffic can never occupy.
+    """
+
+    def __init__(self, max_concurrency: int, per_client: int, per_avatar: int,
+                 admin_slots: int, max_queued_per_client: int, max_queued_total: int,
+                 queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.per_client = per_client
+        self.per_avatar = per_avatar
+        self.admin_slots = admin_slots
+        self.max_queued_per_client = max_queued_per_client
+        self.max_queued_total = max_queued_total
+        self.queue_timeout = queue_timeout
+        self._active_public = 0
+        self._active_admin = 0
+        self._active_clients: Dict[str, int] = defaultdict(int)
+        self._active_avatars: Dict[str, int] = defaultdict(int)
+        self._admin_waiters: Deque[_Waiter] = deque()
+        self._public_waiters: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued_public = 0
+        self._serial = 0
+        self._last_served: Dict[str, float] = {}
+
+    def _admin_can_run(self) -> bool:
+        return self._active_public + self._active_admin < self.max_concurrency + self.admin_slots
+
+    def _public_can_run(self, waiter: _Waiter) -> bool:
+        if self._active_public >= self.max_concurrency or not self._admin_can_run():
+            return False
+        if self._active_clients.get(waiter.client_key, 0) >= self.per_client:
+            return False
+        if waiter.avatar_id and self._active_avatars.get(waiter.avatar_id, 0) >= waiter.avatar_limit:
+            return False
+        return True
+
+    def _grant(self, waiter: _Waiter, admin: bool):
+        if admin:
+            self._active_admin += 1
+        else:
+            self._active_public += 1
+            self._active_clients[waiter.client_key] += 1
+            if waiter.avatar_id:
+                self._active_avatars[waiter.avatar_id] += 1
+            self._serial += 1
+            self._last_served[waiter.client_key] = self._serial
+        if not waiter.future.done():
+            waiter.future.set_result(True)
+
+    def _release(self, waiter: _Waiter, admin: bool):
+        if admin:
+            self._active_admin -= 1
+        else:
+            self._active_public -= 1
+            self._active_clients[waiter.client_key] -= 1
+            if self._active_clients[waiter.client_key] <= 0:
+                del self._active_clients[waiter.client_key]
+                self._forget_client(waiter.client_key)
+            if waiter.avatar_id:
+                self._active_avatars[waiter.avatar_id] -= 1
+                if self._active_avatars[waiter.avatar_id] <= 0:
+                    del self._active_avatars[waiter.avatar_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._admin_waiters and self._admin_can_run():
+            self._grant(self._admin_waiters.popleft(), admin=True)
+
+        while self._public_waiters:
+            eligible = [key for key, queue in self._public_waiters.items() if self._public_can_run(queue[0])]
+            if not eligible:
+                break
+            # Least recently served first; ties keep queue insertion order.
+            client_key = min(eligible, key=lambda key: self._last_served[key])
+            queue = self._public_waiters[client_key]
+            waiter = queue.popleft()
+            self._queued_public -= 1
+            if not queue:
+                del self._public_waiters[client_key]
+            self._grant(waiter, admin=False)
+
+    def _forget_client(self, client_key: str):
+        if client_key not in self._active_clients and client_key not in self._public_waiters:
+            self._last_served.pop(client_key, None)
+
+    def _enqueue(self, waiter: _Waiter, admin: bool):
+        if admin:
+            self._admin_waiters.append(waiter)
+            return
+        queue = self._public_waiters.get(waiter.client_key)
+        queued = len(queue) if queue else 0
+        if queued >= self.max_queued_per_client or self._queued_public >= self.max_queued_total:
+            raise SchedulerOverloaded()
+        if queue is None:
+            queue = self._public_waiters[waiter.client_key] = deque()
+            # New clients rank behind earlier-served clients but ahead of the latest one.
+            self._last_served.setdefault(waiter.client_key, self._serial - 0.5)
+        queue.append(waiter)
+        self._queued_public += 1
+
+    def _dequeue(self, waiter: _Waiter, admin: bool):
+        if admin:
+            if waiter in self._admin_waiters:
+                self._admin_waiters.remove(waiter)
+            return
+        queue = self._public_waiters.get(waiter.client_key)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self._queued_public -= 1
+            if not queue:
+                del self._public_waiters[waiter.client_key]
+                self._forget_client(waiter.client_key)
+
+    @asynccontextmanager
+    async def slot(self, client_key: str, avatar_id: Optional[str] = None,
+                   avatar_limit: Optional[int] = None, admin: bool = False):
+        """Hold a scheduling slot for the duration of the block.
+
+        Raises SchedulerOverloaded if the client's queue is full or no slot
+        frees up within the queue timeout.
+        """
+        waiter = _Waiter(client_key, avatar_id, avatar_limit or self.per_avatar)
+        if admin:
+            idle = not self._admin_waiters and self._admin_can_run()
+        else:
+            idle = client_key not in self._public_waiters and self._public_can_run(waiter)
+
+        if idle:
+            self._grant(waiter, admin)
+        else:
+            self._enqueue(waiter, admin)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.future.done():
+                    # Granted at the same moment we gave up; hand the slot back.
+                    self._release(waiter, admin)
+                else:
+                    self._dequeue(waiter, admin)
+                    waiter.future.cancel()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise SchedulerOverloaded()
+                raise
+
+        try:
+            yield
+        finally:
+            self._release(waiter, admin)
+
+def parse_trusted_proxies(value: str) -> List[IPNetwork]:
+    """Parse a comma-separated list of proxy addresses or CIDR ranges"""
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip()]
+
+def is_trusted_proxy(address: str, trusted: List[IPNetwork]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted)
+
+def resolve_client_ip(peer: str, forwarded_for: Optional[str], trusted: List[IPNetwork]) -> Tuple[str, bool]:
+    """Return the client IP and whether an X-Forwarded-For header was ignored.
+
+    X-Forwarded-For is only honoured when the direct peer is a trusted proxy,
+    and then the rightmost address not belonging to a trusted proxy is used,
+    since everything to its left is supplied by the client.
+    """
+    if not forwarded_for:
+        return peer, False
+    if not is_trusted_proxy(peer, trusted):
+        return peer, True
+
+    host = peer
+    for address in reversed([a.strip() for a in forwarded_for.split(",") if a.strip()]):
+        host = address
+        if not is_trusted_proxy(address, trusted):
+            break
+    return host, False
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -6,11 +6,19 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
+import asyncio
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import jwt
+from chat_archive import (
+    archive_chat_history, query_chat_archive, reconcile_timestamp_index, resolve_ttl_seconds,
+)
+from prompt_budget import (
+    PersonaTooLarge, PromptBudget, PromptTooLarge, output_token_bounds, parse_generation_response,
+)
+from scheduler import FairScheduler, SchedulerOverloaded, parse_trusted_proxies, resolve_client_ip
 try:
     import google.generativeai as genai
     GEMINI_AVAILABLE = True
@@ -40,15 +48,49 @@ AVAILABLE_MODELS = {
     'gemini-2.5-pro': {
         'name': 'Gemini 2.5 Pro',
         'description': 'Most capable model with advanced reasoning',
-        'rate_limit': '2 requests/minute (free tier)'
+        'rate_limit': '2 requests/minute (free tier)',
+        'max_input_tokens': 8192,
+        # Thinking tokens count against the output cap on 2.5 models, so
+        # per-avatar caps are never allowed below min_output_tokens
+        'min_output_tokens': 1024,
+        'max_output_tokens': 4096
     },
     'gemini-2.5-flash': {
         'name': 'Gemini 2.5 Flash',
         'description': 'Fast and efficient for most tasks',
-        'rate_limit': '15 requests/minute (free tier)'
+        'rate_limit': '15 requests/minute (free tier)',
+        'max_input_tokens': 8192,
+        'min_output_tokens': 512,
+        'max_output_tokens': 2048
     }
 }
 
+# Request scheduling configuration
+CHAT_MAX_CONCURRENCY = int(os.environ.get('CHAT_MAX_CONCURRENCY', '8'))
+CHAT_PER_CLIENT_CONCURRENCY = int(os.environ.get('CHAT_PER_CLIENT_CONCURRENCY', '2'))
+CHAT_PER_AVATAR_CONCURRENCY = int(os.environ.get('CHAT_PER_AVATAR_CONCURRENCY', '4'))
+CHAT_MAX_QUEUED_PER_CLIENT = int(os.environ.get('CHAT_MAX_QUEUED_PER_CLIENT', '2'))
+CHAT_MAX_QUEUED_TOTAL = int(os.environ.get('CHAT_MAX_QUEUED_TOTAL', '32'))
+CHAT_QUEUE_TIMEOUT = float(os.environ.get('CHAT_QUEUE_TIMEOUT', '5'))
+ADMIN_RESERVED_SLOTS = int(os.environ.get('ADMIN_RESERVED_SLOTS', '2'))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', '5'))
+# Comma-separated proxy IPs or CIDR ranges whose X-Forwarded-For header is trusted
+TRUSTED_PROXIES = parse_trusted_proxies(os.environ.get('TRUSTED_PROXIES', ''))
+
+# Prompt budgeting configuration
+PROMPT_OVERFLOW_POLICY = os.environ.get('PROMPT_OVERFLOW_POLICY', 'truncate')  # 'truncate' or 'reject'
+PROMPT_MAX_PERSONA_TOKENS = int(os.environ.get('PROMPT_MAX_PERSONA_TOKENS', '2048'))
+PERSONA_TOKEN_CACHE_SIZE = int(os.environ.get('PERSONA_TOKEN_CACHE_SIZE', '512'))
+
+# Chat history retention configuration
+CHAT_HOT_RETENTION_DAYS = int(os.environ.get('CHAT_HOT_RETENTION_DAYS', '30'))
+# Safety-net TTL on the hot collection; 0 disables it. Keep it well above the
+# retention window so messages are archived before MongoDB expires them.
+CHAT_HOT_TTL_DAYS = int(os.environ.get('CHAT_HOT_TTL_DAYS', '0'))
+CHAT_ARCHIVE_DIR = Path(os.environ.get('CHAT_ARCHIVE_DIR', str(ROOT_DIR / 'archive' / 'chat_history')))
+CHAT_ARCHIVE_BATCH_SIZE = int(os.environ.get('CHAT_ARCHIVE_BATCH_SIZE', '1000'))
+CHAT_ARCHIVE_INTERVAL = int(os.environ.get('CHAT_ARCHIVE_INTERVAL', '3600'))
+
 # Global model cache
 model_cache = {}
 
@@ -99,26 +141,51 @@ class AdminToken(BaseModel):
     token_type: str = "bearer"
 
 # Avatar Models
+MIN_AVATAR_OUTPUT_TOKENS, MAX_AVATAR_OUTPUT_TOKENS = output_token_bounds(AVAILABLE_MODELS)
+AVATAR_NAME_MAX_LENGTH = 100
+
+def validate_avatar_output_tokens(value: Optional[int]) -> Optional[int]:
+    # Lower caps would be raised to the model minimum and never take effect
+    if value is not None and not MIN_AVATAR_OUTPUT_TOKENS <= value <= MAX_AVATAR_OUTPUT_TOKENS:
+        raise ValueError(f"max_output_tokens must be between {MIN_AVATAR_OUTPUT_TOKENS} and {MAX_AVATAR_OUTPUT_TOKENS}")
+    return value
+
 class Avatar(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     description: str
     personality: str
     instructions: str
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+    max_output_tokens: Optional[int] = Field(default=None, ge=1)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class AvatarCreate(BaseModel):
-    name: str
+    name: str = Field(max_length=AVATAR_NAME_MAX_LENGTH)
     description: str
     personality: str
     instructions: str
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+    max_output_tokens: Optional[int] = None
+
+    @field_validator('max_output_tokens')
+    @classmethod
+    def check_max_output_tokens(cls, value: Optional[int]) -> Optional[int]:
+        return validate_avatar_output_tokens(value)
 
 class AvatarUpdate(BaseModel):
-    name: Optional[str] = None
+    name: Optional[str] = Field(default=None, max_length=AVATAR_NAME_MAX_LENGTH)
     description: Optional[str] = None
     personality: Optional[str] = None
     instructions: Optional[str] = None
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+    max_output_tokens: Optional[int] = None
+
+    @field_validator('max_output_tokens')
+    @classmethod
+    def check_max_output_tokens(cls, value: Optional[int]) -> Optional[int]:
+        return validate_avatar_output_tokens(value)
 
 # Chat Models
 class ChatMessage(BaseModel):
@@ -126,6 +193,9 @@ class ChatMessage(BaseModel):
     avatar_id: str
     user_message: str
     avatar_response: str
+    model_used: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    response_tokens: Optional[int] = None
     timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 class ChatInput(BaseModel):
@@ -138,6 +208,11 @@ class ChatResponse(BaseModel):
     avatar_name: str
     model_used: str
 
+class GenerationResult(BaseModel):
+    text: str
+    prompt_tokens: Optional[int] = None
+    response_tokens: Optional[int] = None
+
 class ModelInfo(BaseModel):
     id: str
     name: str
@@ -148,6 +223,93 @@ class ModelsResponse(BaseModel):
     available_models: List[ModelInfo]
     default_model: str
 
+# Request scheduling
+scheduler = FairScheduler(
+    max_concurrency=CHAT_MAX_CONCURRENCY,
+    per_client=CHAT_PER_CLIENT_CONCURRENCY,
+    per_avatar=CHAT_PER_AVATAR_CONCURRENCY,
+    admin_slots=ADMIN_RESERVED_SLOTS,
+    max_queued_per_client=CHAT_MAX_QUEUED_PER_CLIENT,
+    max_queued_total=CHAT_MAX_QUEUED_TOTAL,
+    queue_timeout=CHAT_QUEUE_TIMEOUT,
+)
+
+_untrusted_forwarded_warned = False
+
+def get_client_key(request: Request) -> str:
+    """Identify a public client by its IP address"""
+    global _untrusted_forwarded_warned
+    peer = request.client.host if request.client else "unknown"
+    host, ignored_forwarded = resolve_client_ip(peer, request.headers.get("x-forwarded-for"), TRUSTED_PROXIES)
+    if ignored_forwarded and not _untrusted_forwarded_warned:
+        _untrusted_forwarded_warned = True
+        logger.warning(
+            f"Ignoring X-Forwarded-For from untrusted peer {peer}. If the API runs behind a proxy, "
+            f"add its address or CIDR range to TRUSTED_PROXIES, otherwise all visitors share one chat quota"
+        )
+    return f"ip:{host}"
+
+def overloaded_exception() -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+# Prompt budgeting
+prompt_budget = PromptBudget(
+    model_configs=AVAILABLE_MODELS,
+    default_model=DEFAULT_MODEL,
+    max_persona_tokens=PROMPT_MAX_PERSONA_TOKENS,
+    overflow_policy=PROMPT_OVERFLOW_POLICY,
+    cache_size=PERSONA_TOKEN_CACHE_SIZE,
+)
+
+# Chat history retention
+# Whole UTC days older than CHAT_HOT_RETENTION_DAYS are moved out of the hot
+# chat_history collection into the day-partitioned archive in chat_archive.py.
+CHAT_TIMESTAMP_INDEX = "chat_history_timestamp"
+
+def chat_archive_cutoff_date() -> date:
+    """Days before this date are archived"""
+    return (datetime.utcnow() - timedelta(days=CHAT_HOT_RETENTION_DAYS)).date()
+
+def validate_chat_document(doc: dict) -> dict:
+    return ChatMessage(**doc).dict()
+
+async def archive_old_chat_history() -> int:
+    return await archive_chat_history(
+        db.chat_history,
+        db.chat_history_quarantine,
+        CHAT_ARCHIVE_DIR,
+        chat_archive_cutoff_date(),
+        validate_chat_document,
+        CHAT_ARCHIVE_BATCH_SIZE,
+    )
+
+async def ensure_chat_history_indexes():
+    await db.chat_history.create_index("id")
+    ttl = resolve_ttl_seconds(CHAT_HOT_TTL_DAYS, CHAT_HOT_RETENTION_DAYS)
+    action = await reconcile_timestamp_index(db.chat_history, CHAT_TIMESTAMP_INDEX, ttl)
+    if action != "unchanged":
+        logger.info(f"Chat history timestamp index {action} (TTL: {ttl})")
+
+async def chat_retention_loop(wakeup: asyncio.Event):
+    while True:
+        wakeup.clear()
+        try:
+            archived = await archive_old_chat_history()
+            if archived:
+                logger.info(f"Archived {archived} chat messages to {CHAT_ARCHIVE_DIR}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Chat history archival failed: {e}")
+        try:
+            await asyncio.wait_for(wakeup.wait(), CHAT_ARCHIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
 # Authentication functions
 def verify_admin_credentials(username: str, password: str) -> bool:
     return username == "admin" and password == "admin"
@@ -165,34 +327,66 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def admin_lane(admin: str = Depends(verify_token)):
+    """Authenticate an admin and run the request in the admin priority lane"""
+    try:
+        async with scheduler.slot(f"admin:{admin}", admin=True):
+            yield admin
+    except SchedulerOverloaded:
+        raise overloaded_exception()
+
 # AI response function using Gemini
-async def generate_ai_response(avatar: dict, user_message: str, model_name: str = DEFAULT_MODEL) -> str:
+async def generate_ai_response(avatar: dict, user_message: str, model_name: str = DEFAULT_MODEL) -> GenerationResult:
+    selected_model = get_model(model_name)
+
+    # Fit the prompt into the model's input budget; raises PromptTooLarge
+    persona_prompt, persona_tokens = await prompt_budget.persona(avatar, model_name, selected_model)
+    input_limit = prompt_budget.model_config(model_name)['max_input_tokens']
+    user_prompt, user_tokens = await prompt_budget.user_prompt(
+        avatar, user_message, selected_model, input_limit - persona_tokens
+    )
+
     if GEMINI_AVAILABLE:
         try:
-            selected_model = get_model(model_name)
             if selected_model:
-                # Create a personalized prompt for the avatar
-                system_prompt = f"""You are {avatar['name']}, an AI avatar with the following characteristics:
-
-Description: {avatar['description']}
-Personality: {avatar['personality']}
-Instructions: {avatar['instructions']}
-
-You should respond in character as {avatar['name']} with the specified personality. Be natural, engaging, and follow your instructions. Keep responses conversational and appropriately sized for a chat interface (1-3 paragraphs maximum).
-
-User message: {user_message}
-
-Respond as {avatar['name']}:"""
-
-                response = selected_model.generate_content(system_prompt)
-                return response.text.strip()
+                response = await selected_model.generate_content_async(
+                    persona_prompt + user_prompt,
+                    generation_config={"max_output_tokens": prompt_budget.max_output_tokens(avatar, model_name)},
+                )
+                text, prompt_tokens, response_tokens = parse_generation_response(
+                    response, persona_tokens + user_tokens
+                )
+                if text is None:
+                    logger.warning(f"Gemini hit max_output_tokens without text for avatar {avatar.get('id')}")
+                    text = "Sorry, I ran out of room before I could finish my answer. Could you ask something a little more specific?"
+
+                return GenerationResult(
+                    text=text,
+                    prompt_tokens=prompt_tokens,
+                    response_tokens=response_tokens,
+                )
         except Exception as e:
             # Fallback to simulated response if Gemini fails
             logger.error(f"Gemini API error: {e}")
-            return f"Hi! I'm {avatar['name']}. {avatar['personality']} You said: '{user_message}'. I'm experiencing some technical difficulties, but I'm here to help! Can you tell me more about what you'd like to know?"
+            return GenerationResult(
+                text=f"Hi! I'm {avatar['name']}. {avatar['personality']} You said: '{user_message}'. I'm experiencing some technical difficulties, but I'm here to help! Can you tell me more about what you'd like to know?"
+            )
     
     # Fallback simulated response when Gemini is not available
-    return f"Hi! I'm {avatar['name']}. {avatar['personality']} You said: '{user_message}'. Here's my response based on my instructions: {avatar['instructions'][:100]}..."
+    return GenerationResult(
+        text=f"Hi! I'm {avatar['name']}. {avatar['personality']} You said: '{user_message}'. Here's my response based on my instructions: {avatar['instructions'][:100]}..."
+    )
+
+async def check_avatar_persona(avatar: dict):
+    """Reject avatar configurations whose persona cannot fit every model's prompt budget"""
+    for model_name in AVAILABLE_MODELS:
+        try:
+            await prompt_budget.persona(avatar, model_name, get_model(model_name))
+        except PersonaTooLarge:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Avatar persona does not fit the {model_name} prompt budget",
+            )
 
 # Routes
 @api_router.get("/")
@@ -234,31 +428,33 @@ async def admin_login(credentials: AdminLogin):
 
 # Avatar Management Routes (Admin only)
 @api_router.post("/admin/avatars", response_model=Avatar)
-async def create_avatar(avatar_data: AvatarCreate, admin: str = Depends(verify_token)):
+async def create_avatar(avatar_data: AvatarCreate, admin: str = Depends(admin_lane)):
     avatar = Avatar(**avatar_data.dict())
+    await check_avatar_persona(avatar.dict())
     await db.avatars.insert_one(avatar.dict())
     return avatar
 
 @api_router.get("/admin/avatars", response_model=List[Avatar])
-async def get_avatars_admin(admin: str = Depends(verify_token)):
+async def get_avatars_admin(admin: str = Depends(admin_lane)):
     avatars = await db.avatars.find().to_list(1000)
     return [Avatar(**avatar) for avatar in avatars]
 
 @api_router.put("/admin/avatars/{avatar_id}", response_model=Avatar)
-async def update_avatar(avatar_id: str, avatar_data: AvatarUpdate, admin: str = Depends(verify_token)):
+async def update_avatar(avatar_id: str, avatar_data: AvatarUpdate, admin: str = Depends(admin_lane)):
     existing_avatar = await db.avatars.find_one({"id": avatar_id})
     if not existing_avatar:
         raise HTTPException(status_code=404, detail="Avatar not found")
     
     update_data = {k: v for k, v in avatar_data.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
+    await check_avatar_persona({**existing_avatar, **update_data})
     
     await db.avatars.update_one({"id": avatar_id}, {"$set": update_data})
     updated_avatar = await db.avatars.find_one({"id": avatar_id})
     return Avatar(**updated_avatar)
 
 @api_router.delete("/admin/avatars/{avatar_id}")
-async def delete_avatar(avatar_id: str, admin: str = Depends(verify_token)):
+async def delete_avatar(avatar_id: str, admin: str = Depends(admin_lane)):
     result = await db.avatars.delete_one({"id": avatar_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Avatar not found")
@@ -279,7 +475,7 @@ async def get_avatar(avatar_id: str):
 
 # Chat Routes (No authentication required)
 @api_router.post("/chat", response_model=ChatResponse)
-async def chat_with_avatar(chat_input: ChatInput):
+async def chat_with_avatar(chat_input: ChatInput, request: Request):
     avatar = await db.avatars.find_one({"id": chat_input.avatar_id})
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found")
@@ -289,27 +485,68 @@ async def chat_with_avatar(chat_input: ChatInput):
     if selected_model not in AVAILABLE_MODELS:
         selected_model = DEFAULT_MODEL
     
-    ai_response = await generate_ai_response(avatar, chat_input.message, selected_model)
+    try:
+        async with scheduler.slot(
+            get_client_key(request),
+            avatar_id=chat_input.avatar_id,
+            avatar_limit=avatar.get("max_concurrency"),
+        ):
+            result = await generate_ai_response(avatar, chat_input.message, selected_model)
+    except SchedulerOverloaded:
+        raise overloaded_exception()
+    except PromptTooLarge:
+        raise HTTPException(status_code=413, detail="Message is too long")
+    except PersonaTooLarge:
+        logger.error(f"Persona for avatar {chat_input.avatar_id} does not fit the {selected_model} prompt budget")
+        raise HTTPException(status_code=500, detail="Avatar is misconfigured")
     
     # Save chat history
     chat_message = ChatMessage(
         avatar_id=chat_input.avatar_id,
         user_message=chat_input.message,
-        avatar_response=ai_response
+        avatar_response=result.text,
+        model_used=selected_model,
+        prompt_tokens=result.prompt_tokens,
+        response_tokens=result.response_tokens
     )
     await db.chat_history.insert_one(chat_message.dict())
     
     return ChatResponse(
-        response=ai_response, 
+        response=result.text, 
         avatar_name=avatar["name"],
         model_used=selected_model
     )
 
 @api_router.get("/admin/chat-history", response_model=List[ChatMessage])
-async def get_chat_history(admin: str = Depends(verify_token)):
+async def get_chat_history(admin: str = Depends(admin_lane)):
     chat_history = await db.chat_history.find().sort("timestamp", -1).to_list(1000)
     return [ChatMessage(**chat) for chat in chat_history]
 
+@api_router.get("/admin/chat-history/archive", response_model=List[ChatMessage])
+async def get_archived_chat_history(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    avatar_id: Optional[str] = None,
+    limit: int = Query(default=1000, ge=1, le=10000),
+    admin: str = Depends(admin_lane),
+):
+    end_date = end_date or chat_archive_cutoff_date() - timedelta(days=1)
+    start_date = start_date or end_date - timedelta(days=CHAT_HOT_RETENTION_DAYS)
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    if (end_date - start_date).days > 366:
+        raise HTTPException(status_code=400, detail="Date range must not exceed 366 days")
+    records = await query_chat_archive(CHAT_ARCHIVE_DIR, start_date, end_date, avatar_id, limit)
+    return [ChatMessage(**record) for record in records]
+
+@api_router.post("/admin/chat-history/archive", status_code=status.HTTP_202_ACCEPTED)
+async def run_chat_archive(admin: str = Depends(admin_lane)):
+    wakeup = getattr(app.state, "chat_archive_wakeup", None)
+    if wakeup is None:
+        raise HTTPException(status_code=503, detail="Chat archival is not running")
+    wakeup.set()
+    return {"message": "Chat archival scheduled"}
+
 # Legacy status routes
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
@@ -341,6 +578,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_chat_retention():
+    try:
+        await ensure_chat_history_indexes()
+    except Exception as e:
+        logger.error(f"Failed to create chat history indexes: {e}")
+    app.state.chat_archive_wakeup = asyncio.Event()
+    app.state.chat_retention_task = asyncio.create_task(chat_retention_loop(app.state.chat_archive_wakeup))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    task = getattr(app.state, "chat_retention_task", None)
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
     client.close()
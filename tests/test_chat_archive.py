@@ -0,0 +1,241 @@
+import asyncio
+import gzip
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from chat_archive import (
+    ArchivePartWriter,
+    archive_chat_history,
+    archive_partition,
+    query_chat_archive,
+    read_archive_day,
+    reconcile_timestamp_index,
+    resolve_ttl_seconds,
+)
+
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$lt" in condition and not value < condition["$lt"]:
+                return False
+            if "$gte" in condition and not value >= condition["$gte"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction):
+        self.docs = sorted(self.docs, key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    async def to_list(self, length):
+        return [dict(d) for d in self.docs[:length]]
+
+    def __aiter__(self):
+        self._iter = iter([dict(d) for d in self.docs])
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    """The subset of Motor's collection API used by chat_archive"""
+
+    def __init__(self, docs=(), indexes=None, name="chat_history"):
+        self.docs = [dict(d) for d in docs]
+        self.name = name
+        self.indexes = indexes if indexes is not None else {"_id_": {"key": [("_id", 1)]}}
+        self.commands = []
+        self.database = SimpleNamespace(command=self._command)
+
+    def find(self, query=None):
+        return FakeCursor([d for d in self.docs if _matches(d, query or {})])
+
+    async def delete_many(self, query):
+        self.docs = [d for d in self.docs if not _matches(d, query)]
+
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs = [d for d in self.docs if not _matches(d, query)]
+        self.docs.append(dict(doc))
+
+    async def index_information(self):
+        return {name: dict(spec) for name, spec in self.indexes.items()}
+
+    async def create_index(self, keys, name, **options):
+        self.indexes[name] = {"key": keys, **options}
+
+    async def drop_index(self, name):
+        del self.indexes[name]
+
+    async def _command(self, command):
+        self.commands.append(command)
+        index = self.indexes[command["index"]["name"]]
+        index["expireAfterSeconds"] = command["index"]["expireAfterSeconds"]
+
+
+def make_doc(n, timestamp, avatar_id="av1"):
+    return {"_id": f"oid{n}", "id": f"m{n}", "avatar_id": avatar_id, "user_message": f"hi {n}", "timestamp": timestamp}
+
+
+def validate(doc):
+    if "id" not in doc:
+        raise ValueError("missing id")
+    return {k: v for k, v in doc.items() if k != "_id"}
+
+
+def run_archive(collection, quarantine, tmp_path, cutoff_date, batch_size=2):
+    return asyncio.run(archive_chat_history(collection, quarantine, tmp_path, cutoff_date, validate, batch_size))
+
+
+def part_files(tmp_path, day):
+    return sorted(archive_partition(tmp_path, day).glob("part-*.ndjson.gz"))
+
+
+def test_archive_splits_whole_days_into_one_part_each(tmp_path):
+    docs = [
+        make_doc(1, datetime(2026, 1, 1, 1)),
+        make_doc(2, datetime(2026, 1, 1, 23)),
+        make_doc(3, datetime(2026, 1, 1, 12)),
+        make_doc(4, datetime(2026, 1, 2, 5)),
+        make_doc(5, datetime(2026, 1, 3, 5)),
+    ]
+    collection, quarantine = FakeCollection(docs), FakeCollection()
+
+    assert run_archive(collection, quarantine, tmp_path, date(2026, 1, 3)) == 4
+
+    assert [d["id"] for d in collection.docs] == ["m5"]
+    assert len(part_files(tmp_path, date(2026, 1, 1))) == 1
+    assert len(part_files(tmp_path, date(2026, 1, 2))) == 1
+    assert part_files(tmp_path, date(2026, 1, 3)) == []
+    assert [r["id"] for r in read_archive_day(tmp_path, date(2026, 1, 1))] == ["m2", "m3", "m1"]
+
+
+def test_round_trip_preserves_records(tmp_path):
+    doc = make_doc(1, datetime(2026, 1, 1, 8, 30, 15, 123456))
+    doc["user_message"] = "héllo ✨"
+    run_archive(FakeCollection([doc]), FakeCollection(), tmp_path, date(2026, 1, 2))
+
+    assert read_archive_day(tmp_path, date(2026, 1, 1)) == [validate(doc)]
+
+
+def test_reading_filters_by_avatar(tmp_path):
+    docs = [make_doc(1, datetime(2026, 1, 1, 1), "av1"), make_doc(2, datetime(2026, 1, 1, 2), "av2")]
+    run_archive(FakeCollection(docs), FakeCollection(), tmp_path, date(2026, 1, 2))
+
+    assert [r["id"] for r in read_archive_day(tmp_path, date(2026, 1, 1), "av2")] == ["m2"]
+
+
+def test_day_archived_twice_is_deduplicated(tmp_path):
+    docs = [make_doc(1, datetime(2026, 1, 1, 1)), make_doc(2, datetime(2026, 1, 1, 2))]
+    # Simulate a crash after writing but before deleting the hot copies
+    run_archive(FakeCollection(docs), FakeCollection(), tmp_path, date(2026, 1, 2))
+    run_archive(FakeCollection(docs), FakeCollection(), tmp_path, date(2026, 1, 2))
+
+    assert len(part_files(tmp_path, date(2026, 1, 1))) == 2
+    assert [r["id"] for r in read_archive_day(tmp_path, date(2026, 1, 1))] == ["m2", "m1"]
+
+
+def test_unreadable_parts_are_skipped(tmp_path):
+    run_archive(FakeCollection([make_doc(1, datetime(2026, 1, 1, 1))]), FakeCollection(), tmp_path, date(2026, 1, 2))
+    partition = archive_partition(tmp_path, date(2026, 1, 1))
+    good = part_files(tmp_path, date(2026, 1, 1))[0]
+    (partition / "part-truncated.ndjson.gz").write_bytes(good.read_bytes()[:-6])
+    (partition / "part-badjson.ndjson.gz").write_bytes(gzip.compress(b"{not json\n"))
+    (partition / "part-notgzip.ndjson.gz").write_bytes(b"plain text")
+
+    assert [r["id"] for r in read_archive_day(tmp_path, date(2026, 1, 1))] == ["m1"]
+
+
+def test_uncommitted_writer_is_invisible(tmp_path):
+    writer = ArchivePartWriter(tmp_path, date(2026, 1, 1))
+    writer.write([validate(make_doc(1, datetime(2026, 1, 1, 1)))])
+    assert read_archive_day(tmp_path, date(2026, 1, 1)) == []
+    writer.abort()
+    assert list(archive_partition(tmp_path, date(2026, 1, 1)).iterdir()) == []
+
+
+def test_invalid_documents_are_quarantined(tmp_path):
+    bad = {"_id": "bad", "timestamp": datetime(2026, 1, 1, 0, 30)}
+    docs = [bad, make_doc(1, datetime(2026, 1, 1, 1)), make_doc(2, datetime(2026, 1, 2, 1))]
+    collection, quarantine = FakeCollection(docs), FakeCollection()
+
+    assert run_archive(collection, quarantine, tmp_path, date(2026, 1, 3)) == 2
+    assert collection.docs == []
+    assert quarantine.docs == [bad]
+
+
+def test_day_with_only_invalid_documents_writes_no_part(tmp_path):
+    bad = {"_id": "bad", "timestamp": datetime(2026, 1, 1, 0, 30)}
+    collection, quarantine = FakeCollection([bad]), FakeCollection()
+
+    assert run_archive(collection, quarantine, tmp_path, date(2026, 1, 2)) == 0
+    assert part_files(tmp_path, date(2026, 1, 1)) == []
+    assert quarantine.docs == [bad]
+
+
+def test_query_walks_days_newest_first_and_honours_limit(tmp_path):
+    docs = [make_doc(n, datetime(2026, 1, 1) + timedelta(hours=10 * n)) for n in range(8)]
+    run_archive(FakeCollection(docs), FakeCollection(), tmp_path, date(2026, 1, 10))
+
+    records = asyncio.run(query_chat_archive(tmp_path, date(2026, 1, 1), date(2026, 1, 9), None, 5))
+    assert [r["id"] for r in records] == ["m7", "m6", "m5", "m4", "m3"]
+
+    records = asyncio.run(query_chat_archive(tmp_path, date(2026, 1, 2), date(2026, 1, 2), None, 100))
+    assert [r["id"] for r in records] == ["m4", "m3"]
+
+
+def test_resolve_ttl_seconds():
+    assert resolve_ttl_seconds(0, 30) is None
+    assert resolve_ttl_seconds(30, 30) is None
+    assert resolve_ttl_seconds(45, 30) == 45 * 86400
+
+
+def reconcile(collection, ttl):
+    return asyncio.run(reconcile_timestamp_index(collection, "chat_history_timestamp", ttl))
+
+
+def test_reconcile_creates_index_and_drops_stray_timestamp_indexes():
+    collection = FakeCollection(indexes={
+        "_id_": {"key": [("_id", 1)]},
+        "timestamp_-1": {"key": [("timestamp", -1)]},
+        "timestamp_1": {"key": [("timestamp", 1)], "expireAfterSeconds": 100},
+    })
+    assert reconcile(collection, None) == "created"
+    assert set(collection.indexes) == {"_id_", "chat_history_timestamp"}
+    assert "expireAfterSeconds" not in collection.indexes["chat_history_timestamp"]
+    assert reconcile(collection, None) == "unchanged"
+
+
+def test_reconcile_changes_ttl_with_collmod():
+    collection = FakeCollection()
+    reconcile(collection, 100)
+    assert reconcile(collection, 200) == "updated"
+    assert collection.commands == [{
+        "collMod": "chat_history",
+        "index": {"name": "chat_history_timestamp", "expireAfterSeconds": 200},
+    }]
+    assert collection.indexes["chat_history_timestamp"]["expireAfterSeconds"] == 200
+
+
+def test_reconcile_rebuilds_when_ttl_is_removed_or_added():
+    collection = FakeCollection()
+    reconcile(collection, 100)
+    assert reconcile(collection, None) == "rebuilt"
+    assert "expireAfterSeconds" not in collection.indexes["chat_history_timestamp"]
+
+    assert reconcile(collection, 300) == "rebuilt"
+    assert collection.indexes["chat_history_timestamp"]["expireAfterSeconds"] == 300
+    assert collection.commands == []
@@ -0,0 +1,219 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from prompt_budget import (
+    PersonaTooLarge,
+    PromptBudget,
+    PromptTooLarge,
+    build_user_prompt,
+    output_token_bounds,
+    parse_generation_response,
+)
+
+MODEL_CONFIGS = {
+    'pro': {'max_input_tokens': 1000, 'min_output_tokens': 1024, 'max_output_tokens': 4096},
+    'flash': {'max_input_tokens': 1000, 'min_output_tokens': 512, 'max_output_tokens': 2048},
+}
+
+
+class FakeModel:
+    """Counts one token per three characters and records every call"""
+
+    def __init__(self, chars_per_token=3):
+        self.chars_per_token = chars_per_token
+        self.calls = []
+
+    async def count_tokens_async(self, text):
+        self.calls.append(text)
+        return SimpleNamespace(total_tokens=len(text) // self.chars_per_token)
+
+
+def make_budget(**overrides):
+    options = dict(
+        model_configs=MODEL_CONFIGS,
+        default_model='pro',
+        max_persona_tokens=2048,
+        overflow_policy='truncate',
+        cache_size=4,
+    )
+    options.update(overrides)
+    return PromptBudget(**options)
+
+
+def make_avatar(**overrides):
+    avatar = {
+        'id': 'a1',
+        'name': 'Zeny',
+        'description': 'A helpful assistant',
+        'personality': 'Friendly',
+        'instructions': 'Answer clearly',
+        'updated_at': 1,
+    }
+    avatar.update(overrides)
+    return avatar
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_persona_within_budget_is_unchanged():
+    model = FakeModel()
+    prompt, tokens = run(make_budget().persona(make_avatar(), 'pro', model))
+    assert 'Instructions: Answer clearly' in prompt
+    assert tokens == len(prompt) // 3
+
+
+def test_persona_fields_are_truncated_to_budget():
+    model = FakeModel()
+    avatar = make_avatar(description='d' * 5000, personality='p' * 5000, instructions='i' * 5000)
+    prompt, tokens = run(make_budget().persona(avatar, 'pro', model))
+
+    # Persona is capped at half the input budget, fields at a quarter of that
+    assert tokens <= 500
+    assert prompt.count('d' * 10) * 10 <= 125 * 3
+    assert 'i' * 10 in prompt
+
+
+def test_persona_cache_is_keyed_on_model_id_and_revision():
+    model = FakeModel()
+    budget = make_budget()
+    avatar = make_avatar()
+
+    run(budget.persona(avatar, 'pro', model))
+    calls = len(model.calls)
+    run(budget.persona(avatar, 'pro', model))
+    assert len(model.calls) == calls
+
+    run(budget.persona(avatar, 'flash', model))
+    assert len(model.calls) > calls
+    calls = len(model.calls)
+
+    run(budget.persona(make_avatar(updated_at=2, instructions='New'), 'pro', model))
+    assert len(model.calls) > calls
+
+
+def test_persona_cache_evicts_least_recently_used():
+    model = FakeModel()
+    budget = make_budget(cache_size=2)
+    for avatar_id in ('a', 'b', 'c'):
+        run(budget.persona(make_avatar(id=avatar_id), 'pro', model))
+
+    calls = len(model.calls)
+    run(budget.persona(make_avatar(id='a'), 'pro', model))
+    assert len(model.calls) > calls
+
+
+def test_oversized_name_raises_persona_too_large_and_is_cached():
+    model = FakeModel()
+    budget = make_budget()
+    avatar = make_avatar(name='N' * 20000)
+
+    with pytest.raises(PersonaTooLarge):
+        run(budget.persona(avatar, 'pro', model))
+    calls = len(model.calls)
+    with pytest.raises(PersonaTooLarge):
+        run(budget.persona(avatar, 'pro', model))
+    assert len(model.calls) == calls
+
+
+def test_short_user_message_skips_count_tokens():
+    model = FakeModel()
+    prompt, _ = run(make_budget().user_prompt(make_avatar(), 'hello', model, 100))
+    assert prompt == build_user_prompt(make_avatar(), 'hello')
+    assert model.calls == []
+
+
+def test_multibyte_message_is_counted():
+    model = FakeModel(chars_per_token=1)
+    message = 'é' * 40  # 80 bytes but 40 characters
+    prompt, tokens = run(make_budget().user_prompt(make_avatar(), message, model, 90))
+    assert model.calls
+    assert tokens <= 90
+    assert message[:10] in prompt
+
+
+def test_truncate_policy_shortens_message():
+    model = FakeModel()
+    prompt, tokens = run(make_budget().user_prompt(make_avatar(), 'y' * 5000, model, 200))
+    assert tokens <= 200
+    assert 'y' in prompt
+    assert prompt.endswith('Respond as Zeny:')
+
+
+def test_truncate_policy_never_sends_empty_message():
+    model = FakeModel()
+    with pytest.raises(PromptTooLarge):
+        # The prompt template alone exceeds the limit
+        run(make_budget().user_prompt(make_avatar(), 'y' * 5000, model, 3))
+
+
+def test_reject_policy_raises_for_oversized_message():
+    model = FakeModel()
+    budget = make_budget(overflow_policy='reject')
+    with pytest.raises(PromptTooLarge):
+        run(budget.user_prompt(make_avatar(), 'y' * 5000, model, 200))
+
+    message = 'y' * 300
+    prompt, tokens = run(budget.user_prompt(make_avatar(), message, model, 200))
+    assert message in prompt
+    assert tokens <= 200
+
+
+def test_exhausted_input_budget_raises():
+    with pytest.raises(PromptTooLarge):
+        run(make_budget().user_prompt(make_avatar(), 'hi', FakeModel(), 0))
+
+
+def test_count_tokens_falls_back_to_estimate():
+    class BrokenModel:
+        async def count_tokens_async(self, text):
+            raise RuntimeError("quota exceeded")
+
+    budget = make_budget()
+    assert run(budget.count_tokens(BrokenModel(), 'x' * 40)) == 10
+    assert run(budget.count_tokens(None, 'x' * 40)) == 10
+
+
+def test_max_output_tokens_clamp():
+    budget = make_budget()
+    assert budget.max_output_tokens({}, 'pro') == 4096
+    assert budget.max_output_tokens({'max_output_tokens': 2000}, 'pro') == 2000
+    assert budget.max_output_tokens({'max_output_tokens': 100}, 'pro') == 1024
+    assert budget.max_output_tokens({'max_output_tokens': 4096}, 'flash') == 2048
+    assert budget.max_output_tokens({}, 'unknown') == 4096
+
+
+def test_output_token_bounds():
+    assert output_token_bounds(MODEL_CONFIGS) == (1024, 4096)
+
+
+def make_response(text='Hello there', parts=True, finish_reason='STOP', usage=(120, 200)):
+    candidate = SimpleNamespace(
+        content=SimpleNamespace(parts=[text] if parts else []),
+        finish_reason=SimpleNamespace(name=finish_reason),
+    )
+    response = SimpleNamespace(candidates=[candidate], text=f"  {text}  ")
+    if usage is not None:
+        response.usage_metadata = SimpleNamespace(prompt_token_count=usage[0], total_token_count=usage[1])
+    return response
+
+
+def test_parse_generation_response_uses_usage_metadata():
+    assert parse_generation_response(make_response(), 50) == ('Hello there', 120, 80)
+
+
+def test_parse_generation_response_without_usage_keeps_estimate():
+    assert parse_generation_response(make_response(usage=None), 50) == ('Hello there', 50, None)
+
+
+def test_parse_generation_response_max_tokens_without_text():
+    response = make_response(parts=False, finish_reason='MAX_TOKENS', usage=(120, 1144))
+    assert parse_generation_response(response, 50) == (None, 120, 1024)
+
+
+def test_parse_generation_response_max_tokens_with_partial_text():
+    response = make_response(text='Partial', finish_reason='MAX_TOKENS')
+    assert parse_generation_response(response, 50)[0] == 'Partial'
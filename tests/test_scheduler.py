@@ -0,0 +1,248 @@
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler, SchedulerOverloaded, parse_trusted_proxies, resolve_client_ip
+
+
+def make_scheduler(**overrides):
+    options = dict(
+        max_concurrency=4,
+        per_client=1,
+        per_avatar=4,
+        admin_slots=1,
+        max_queued_per_client=2,
+        max_queued_total=8,
+        queue_timeout=1.0,
+    )
+    options.update(overrides)
+    return FairScheduler(**options)
+
+
+def assert_idle(scheduler):
+    assert scheduler._active_public == 0
+    assert scheduler._active_admin == 0
+    assert scheduler._queued_public == 0
+    assert not scheduler._active_clients
+    assert not scheduler._active_avatars
+    assert not scheduler._public_waiters
+    assert not scheduler._admin_waiters
+    assert not scheduler._last_served
+
+
+async def hold(scheduler, release, started, name, **kwargs):
+    async with scheduler.slot(kwargs.pop("client_key", name), **kwargs):
+        started.append(name)
+        await release.wait()
+
+
+def test_per_client_limit_queues_second_request():
+    async def run():
+        scheduler = make_scheduler(per_client=1)
+        release, started = asyncio.Event(), []
+        tasks = [asyncio.create_task(hold(scheduler, release, started, f"a{i}", client_key="a")) for i in range(2)]
+        await asyncio.sleep(0.01)
+        assert started == ["a0"]
+        assert scheduler._queued_public == 1
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == ["a0", "a1"]
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_per_avatar_limit_and_override():
+    async def run():
+        scheduler = make_scheduler(per_client=4, per_avatar=1)
+        release, started = asyncio.Event(), []
+        tasks = [
+            asyncio.create_task(hold(scheduler, release, started, "a", avatar_id="av1")),
+            asyncio.create_task(hold(scheduler, release, started, "b", avatar_id="av1")),
+            asyncio.create_task(hold(scheduler, release, started, "c", avatar_id="av2", avatar_limit=2)),
+            asyncio.create_task(hold(scheduler, release, started, "d", avatar_id="av2", avatar_limit=2)),
+        ]
+        await asyncio.sleep(0.01)
+        assert sorted(started) == ["a", "c", "d"]
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert sorted(started) == ["a", "b", "c", "d"]
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_round_robin_across_clients():
+    async def run():
+        scheduler = make_scheduler(max_concurrency=1, per_client=1, max_queued_per_client=3)
+        release, started = asyncio.Event(), []
+        names = ["a0", "a1", "a2", "b0", "c0"]
+        tasks = []
+        for name in names:
+            tasks.append(asyncio.create_task(hold(scheduler, release, started, name, client_key=name[0])))
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == ["a0", "b0", "c0", "a1", "a2"]
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_queue_overflow_raises():
+    async def run():
+        scheduler = make_scheduler(max_queued_per_client=1)
+        release, started = asyncio.Event(), []
+        tasks = [asyncio.create_task(hold(scheduler, release, started, f"a{i}", client_key="a")) for i in range(2)]
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(SchedulerOverloaded):
+            async with scheduler.slot("a"):
+                pass
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_total_queue_overflow_raises():
+    async def run():
+        scheduler = make_scheduler(max_concurrency=1, max_queued_total=1)
+        release, started = asyncio.Event(), []
+        tasks = [asyncio.create_task(hold(scheduler, release, started, name)) for name in ("a", "b")]
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(SchedulerOverloaded):
+            async with scheduler.slot("c"):
+                pass
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_raises_and_resets_counters():
+    async def run():
+        scheduler = make_scheduler(queue_timeout=0.05)
+        release, started = asyncio.Event(), []
+        holder = asyncio.create_task(hold(scheduler, release, started, "a0", client_key="a"))
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(SchedulerOverloaded):
+            async with scheduler.slot("a"):
+                pass
+        assert scheduler._queued_public == 0
+
+        release.set()
+        await holder
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_resets_counters():
+    async def run():
+        scheduler = make_scheduler()
+        release, started = asyncio.Event(), []
+        holder = asyncio.create_task(hold(scheduler, release, started, "a0", client_key="a"))
+        waiter = asyncio.create_task(hold(scheduler, release, started, "a1", client_key="a"))
+        await asyncio.sleep(0.01)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler._queued_public == 0
+
+        release.set()
+        await holder
+        assert started == ["a0"]
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_cancelled_holder_releases_slot():
+    async def run():
+        scheduler = make_scheduler()
+        release, started = asyncio.Event(), []
+        holder = asyncio.create_task(hold(scheduler, release, started, "a", avatar_id="av1"))
+        await asyncio.sleep(0.01)
+
+        holder.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await holder
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_admin_served_before_public_waiters():
+    async def run():
+        scheduler = make_scheduler(max_concurrency=1, admin_slots=0)
+        release_first, release_rest, started = asyncio.Event(), asyncio.Event(), []
+        first = asyncio.create_task(hold(scheduler, release_first, started, "p0"))
+        await asyncio.sleep(0.01)
+        public = asyncio.create_task(hold(scheduler, release_rest, started, "p1"))
+        await asyncio.sleep(0)
+        admin = asyncio.create_task(hold(scheduler, release_rest, started, "admin", admin=True))
+        await asyncio.sleep(0.01)
+        assert started == ["p0"]
+
+        release_first.set()
+        await asyncio.sleep(0.01)
+        assert started == ["p0", "admin"]
+
+        release_rest.set()
+        await asyncio.gather(first, public, admin)
+        assert started == ["p0", "admin", "p1"]
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_admin_reserved_slots_unavailable_to_public():
+    async def run():
+        scheduler = make_scheduler(max_concurrency=1, admin_slots=1, queue_timeout=0.05)
+        release, started = asyncio.Event(), []
+        holder = asyncio.create_task(hold(scheduler, release, started, "a"))
+        await asyncio.sleep(0.01)
+
+        async with scheduler.slot("admin", admin=True):
+            started.append("admin")
+        with pytest.raises(SchedulerOverloaded):
+            async with scheduler.slot("b"):
+                pass
+
+        release.set()
+        await holder
+        assert started == ["a", "admin"]
+        assert_idle(scheduler)
+
+    asyncio.run(run())
+
+
+def test_resolve_client_ip_ignores_untrusted_forwarded_for():
+    trusted = parse_trusted_proxies("10.0.0.0/8")
+    assert resolve_client_ip("203.0.113.5", None, trusted) == ("203.0.113.5", False)
+    assert resolve_client_ip("203.0.113.5", "198.51.100.1", trusted) == ("203.0.113.5", True)
+
+
+def test_resolve_client_ip_uses_rightmost_untrusted_address():
+    trusted = parse_trusted_proxies("10.0.0.0/8, 192.168.1.1, fd00::/8")
+    assert resolve_client_ip("10.1.2.3", "1.1.1.1, 198.51.100.7, 192.168.1.1", trusted) == ("198.51.100.7", False)
+    assert resolve_client_ip("fd00::1", "2001:db8::5", trusted) == ("2001:db8::5", False)
+    # Only trusted hops: fall back to the leftmost address
+    assert resolve_client_ip("10.0.0.1", "10.0.0.2", trusted) == ("10.0.0.2", False)
+
+
+def test_parse_trusted_proxies_rejects_invalid_entries():
+    assert parse_trusted_proxies("") == []
+    with pytest.raises(ValueError):
+        parse_trusted_proxies("not-an-ip")